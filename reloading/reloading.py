@@ -1,9 +1,11 @@
-import inspect
 import sys
+import os
 import ast
-import traceback
+import copy
 import types
-from itertools import chain
+import hashlib
+import time
+from collections import ChainMap, namedtuple
 from functools import partial, update_wrapper
 
 
@@ -30,6 +32,10 @@ def reloading(fn_or_seq=None, every=1, forever=None):
     Pass the integer keyword argument `every` to reload the source code
     only every n-th iteration/invocation.
 
+    Set the environment variable `RELOADING=0` to disable reloading, e.g. for
+    production runs. Loops then iterate `fn_or_seq` directly and functions are
+    returned undecorated, without any overhead.
+
     Args:
         fn_or_seq (function | iterable): A function or loop iterator which should
             be reloaded from source before each invocation or iteration,
@@ -39,12 +45,16 @@ def reloading(fn_or_seq=None, every=1, forever=None):
             create an endless loop
 
     """
-    if fn_or_seq:
+    if fn_or_seq is None and forever:
+        fn_or_seq = iter(int, 1)
+    # compare against None, as empty iterables or e.g. arrays can't be told
+    # apart from a missing argument by their truth value
+    if fn_or_seq is not None:
+        if os.environ.get("RELOADING") == "0":
+            return fn_or_seq
         if isinstance(fn_or_seq, types.FunctionType):
             return _reloading_function(fn_or_seq, every=every)
         return _reloading_loop(fn_or_seq, every=every)
-    if forever:
-        return _reloading_loop(iter(int, 1), every=every)
 
     # return this function with the keyword arguments partialed in,
     # so that the return value can be used as a decorator
@@ -52,63 +62,185 @@ def reloading(fn_or_seq=None, every=1, forever=None):
     return decorator
 
 
-def unique_name(used):
-    # get the longest element of the used names and append a "0"
-    return max(used, key=len) + "0"
+# the name in the caller's namespace that the values of the iteration variables are written into.
+# a dunder name including the package name can't clash with the user's names. it's the same for
+# every loop, so that the compiled loop body can be reused when a loop is entered again
+_ITERVARS_NAME = "__reloading_itervars__"
 
 
-def format_itervars(ast_node):
-    """Formats an `ast_node` of loop iteration variables as string, e.g. 'a, b'"""
+# seconds to wait for a file that was read before to reappear, as editors which
+# save by replacing the file briefly remove it
+MISSING_FILE_TIMEOUT = 1.0
 
-    # handle the case that there only is a single loop var
-    if isinstance(ast_node, ast.Name):
-        return ast_node.id
 
-    names = []
-    for child in ast_node.elts:
-        if isinstance(child, ast.Name):
-            names.append(child.id)
-        elif isinstance(child, ast.Tuple) or isinstance(child, ast.List):
-            # if its another tuple, like "a, (b, c)", recurse
-            names.append("({})".format(format_itervars(child)))
+def load_file(path, missing_timeout=0):
+    """Returns the raw source of the file at `path`. Reading bytes leaves
+    decoding to `ast.parse`, which respects encoding declarations. Raises
+    FileNotFoundError if the file is still missing after `missing_timeout`
+    seconds"""
+    delay = 0.0005
+    deadline = time.monotonic() + missing_timeout
+    # while saving, the file may sometimes be empty or missing. back off
+    # instead of spinning until the editor finished writing it
+    while True:
+        try:
+            with open(path, "rb") as f:
+                src = f.read()
+        except FileNotFoundError:
+            # e.g. code run with `python -c` or in a notebook has no file
+            if time.monotonic() >= deadline:
+                raise
+            src = b""
+        if src:
+            return src + b"\n"
+        time.sleep(delay)
+        delay = min(2 * delay, 0.05)
+
+
+# raw source files, keyed by path. each entry holds the stamp of the file at
+# read time so that the file is only read again once it changed
+_SOURCE_CACHE = {}
+
+# the raw source of a file and its lines, split once when the file is read
+Source = namedtuple("Source", ["data", "lines"])
+
+# parsed source files, keyed by path. each entry holds the source the tree
+# was parsed from so that the tree is only re-parsed once the source changed,
+# the tree and its index
+_AST_CACHE = {}
+
+# the reloading loops of a tree by loop id and by line number, each as a list,
+# and the first definition of each function decorated with reloading by name
+TreeIndex = namedtuple("TreeIndex", ["loops_by_id", "loops_by_lineno", "functions_by_name"])
+
+
+def file_stamp(path):
+    """Returns a cheap fingerprint of the file at `path` which changes whenever
+    the file gets written. The inode changes when editors save by replacing
+    the file, even if modification time and size happen to match"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        # the file is being replaced, or there is no file at all
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def load_source(path):
+    """Returns the source of the file at `path`, cached until the file changes"""
+    # stat before reading so that a write racing the read invalidates the entry
+    stamp = file_stamp(path)
+    cached = _SOURCE_CACHE.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    # only wait for files that existed, otherwise a missing file would never appear
+    data = load_file(path, missing_timeout=MISSING_FILE_TIMEOUT if cached is not None else 0)
+    if cached is not None and cached[1].data == data:
+        # the file was written without changing it, e.g. touched or saved
+        # again. keep the cached source so that the parsed tree stays valid
+        source = cached[1]
+    else:
+        source = Source(data, data.splitlines(True))
+    _SOURCE_CACHE[path] = (stamp, source)
+    return source
+
 
-    return ", ".join(names)
+def source_digest(source, start, end):
+    """Returns a digest of the lines `start` to `end` of `source`, counting
+    from 1 and including `end`. Digests from `start` to the end of the source
+    if `end` is None"""
+    lines = source.lines[start - 1:end]
+    return hashlib.blake2b(b"".join(lines), digest_size=16).digest()
 
 
-def load_file(path):
-    src = ""
-    # while loop here since while saving, the file may sometimes be empty.
-    while (src == ""):
-        with open(path, "r") as f:
-            src = f.read()
-    return src + "\n"
+def get_line_range(node):
+    """Returns the first and last line of a statement, including decorators.
+    The last line is None before Python 3.8, which makes digests cover the
+    lines from the statement to the end of the file"""
+    start = min([node.lineno] + [dec.lineno for dec in getattr(node, "decorator_list", [])])
+    return start, getattr(node, "end_lineno", None)
 
 
 def parse_file_until_successful(path):
-    source = load_file(path)
+    """Parses the file at `path`, waiting for the user to fix syntax errors.
+    Returns the source the tree was parsed from, the tree and its index. The
+    tree is cached until the file changes and must not be modified"""
+    source = load_source(path)
+    cached = _AST_CACHE.get(path)
+    if cached is not None and cached[0] is source:
+        return cached
+
     while True:
         try:
-            tree = ast.parse(source)
-            return tree
+            tree = ast.parse(source.data, filename=path)
+            break
         except SyntaxError:
             handle_exception(path)
-            source = load_file(path)
+            source = load_source(path)
+
+    parsed = source, tree, index_tree(tree)
+    _AST_CACHE[path] = parsed
+    return parsed
+
+
+# in the order the fields appear in the source, e.g. of a `try` statement
+_STATEMENT_FIELDS = ("body", "handlers", "orelse", "finalbody", "cases")
+# node type -> the fields of `_STATEMENT_FIELDS` that the type has
+_STATEMENT_FIELDS_BY_TYPE = {}
+
+
+def get_child_statements(node):
+    fields = _STATEMENT_FIELDS_BY_TYPE.get(type(node))
+    if fields is None:
+        fields = tuple(field for field in _STATEMENT_FIELDS if field in node._fields)
+        _STATEMENT_FIELDS_BY_TYPE[type(node)] = fields
+    return [child for field in fields for child in getattr(node, field)]
+
+
+def iter_statements(node):
+    """Yields all statements nested in `node` in source order. Unlike `ast.walk`,
+    this doesn't descend into expressions, which can't contain loops or function
+    definitions"""
+    # an explicit stack instead of recursive generators, which would resume
+    # every enclosing generator for each nested statement
+    stack = get_child_statements(node)[::-1]
+    while stack:
+        child = stack.pop()
+        yield child
+        stack.extend(get_child_statements(child)[::-1])
 
 
-def isolate_loop_body_and_get_itervars(tree, lineno, loop_id):
-    """Modifies tree inplace as unclear how to create ast.Module.
-    Returns itervars"""
-    candidate_nodes = []
-    for node in ast.walk(tree):
+def index_tree(tree):
+    """Finds the reloading loops and functions in `tree` in a single pass, so
+    that reloads can look them up without walking the tree again"""
+    index = TreeIndex({}, {}, {})
+    for node in iter_statements(tree):
         if (
             isinstance(node, ast.For)
             and isinstance(node.iter, ast.Call)
-            and node.iter.func.id == "reloading"
-            and (
-                    (loop_id is not None and loop_id == get_loop_id(node))
-                    or getattr(node, "lineno", None) == lineno
-                )
-            ):
+            # recognised like decorators, e.g. `reloading(...)` or `reloading.reloading(...)`
+            and get_decorator_name_or_none(node.iter.func) == "reloading"
+        ):
+            index.loops_by_id.setdefault(get_loop_id(node), []).append(node)
+            index.loops_by_lineno.setdefault(node.lineno, []).append(node)
+        elif (
+            isinstance(node, ast.FunctionDef)
+            and "reloading" in [
+                get_decorator_name_or_none(dec)
+                for dec in node.decorator_list
+            ]
+        ):
+            index.functions_by_name.setdefault(node.name, node)
+    return index
+
+
+def isolate_loop_body_and_get_itervars(index, lineno, loop_id):
+    """Returns a new module containing only the body of the reloading loop,
+    the loop's iteration variables and its id. Leaves the indexed tree untouched"""
+    candidate_nodes = list(index.loops_by_id.get(loop_id, []))
+    for node in index.loops_by_lineno.get(lineno, []):
+        if not any(node is candidate for candidate in candidate_nodes):
             candidate_nodes.append(node)
 
     if len(candidate_nodes) > 1:
@@ -122,142 +254,232 @@ def isolate_loop_body_and_get_itervars(tree, lineno, loop_id):
         )
 
     loop_node = candidate_nodes[0]
-    tree.body = loop_node.body
-    return loop_node.target, get_loop_id(loop_node)
+    body = ast.Module(body=loop_node.body, type_ignores=[])
+    return body, loop_node.target, get_loop_id(loop_node), get_line_range(loop_node)
 
 
 def get_loop_id(ast_node):
-    """Generates a unique identifier for an `ast_node` of type ast.For to find the loop in the changed source file
+    """Generates a unique identifier for an `ast_node` of type ast.For to find the loop in the changed source file.
+    Positions can't be used, as they change whenever lines are added above the loop
     """
-    return ast.dump(ast_node.target) + "__" + ast.dump(ast_node.iter)
+    return ast.dump(ast_node.target), ast.dump(ast_node.iter)
+
+
+# compiled loop bodies, keyed by path and line number of the loop when it
+# started. each entry holds the id, line range and digest of the loop the code
+# was compiled from, so that edits elsewhere in the file don't cause a re-parse
+_LOOP_CODE_CACHE = {}
 
 
-def get_loop_code(loop_frame_info, loop_id):
-    fpath = loop_frame_info[1]
+def get_loop_code(fpath, lineno, loop_id):
+    """Returns the compiled body of the reloading loop and the loop's id. The
+    body starts by assigning the value stored under `_ITERVARS_NAME` to the
+    loop's iteration variables"""
     while True:
-        tree = parse_file_until_successful(fpath)
+        cached = _LOOP_CODE_CACHE.get((fpath, lineno))
+        if cached is not None:
+            # a loop that is entered again doesn't know its id yet. take it from the
+            # cache, as lines may have been added above the loop since it started
+            if loop_id is None:
+                loop_id = cached[0]
+            # the digest ensures that the cached code is that of the loop's lines
+            if loop_id == cached[0]:
+                _, (start, end), digest, loop_code = cached
+                if source_digest(load_source(fpath), start, end) == digest:
+                    return loop_code
+
+        source, _, index = parse_file_until_successful(fpath)
         try:
-            itervars, found_loop_id = isolate_loop_body_and_get_itervars(tree, lineno=loop_frame_info[2], loop_id=loop_id)
-            return compile(tree, filename="", mode="exec"), format_itervars(itervars), found_loop_id
-        except LookupError:
+            body, itervars, found_loop_id, (start, end) = isolate_loop_body_and_get_itervars(index, lineno=lineno, loop_id=loop_id)
+            # prepend the assignment of the iteration variables, so that a
+            # single exec runs an iteration. it's attributed to the loop's
+            # target, so that errors while unpacking point to the loop header
+            assign_itervars = ast.Assign(targets=[itervars], value=ast.Name(id=_ITERVARS_NAME, ctx=ast.Load()))
+            ast.copy_location(assign_itervars, itervars)
+            ast.copy_location(assign_itervars.value, itervars)
+            body = ast.Module(body=[assign_itervars] + body.body, type_ignores=[])
+            # compiling with the real file name makes tracebacks and debuggers
+            # point to the original source, as the body keeps its line numbers
+            compiled_body = compile(body, filename=fpath, mode="exec", dont_inherit=True)
+            loop_code = compiled_body, found_loop_id
+            # the source the tree was parsed from is the one to digest
+            digest = source_digest(source, start, end)
+            _LOOP_CODE_CACHE[(fpath, lineno)] = (found_loop_id, (start, end), digest, loop_code)
+            return loop_code
+        except (LookupError, SyntaxError):
+            # compile raises SyntaxErrors that parsing doesn't, e.g. for a
+            # `break` in the loop body, which isn't inside a loop once isolated
             handle_exception(fpath)
 
 
 def handle_exception(fpath):
-    exc = traceback.format_exc()
-    exc = exc.replace('File "<string>"', 'File "{}"'.format(fpath))
-    sys.stderr.write(exc + "\n")
+    # only imported when needed, as it is slow to import and rarely used
+    import traceback
+
+    sys.stderr.write(traceback.format_exc() + "\n")
     print("Edit {} and press return to continue".format(fpath))
-    sys.stdin.readline()
+    if not sys.stdin.readline():
+        # stdin is closed, so nobody can fix the code. retrying would only
+        # fail again, hence re-raise the exception that is being handled
+        raise
 
 
 def _reloading_loop(seq, every=1):
-    loop_frame_info = inspect.stack()[2]
-    fpath = loop_frame_info[1]
+    # the frame of the loop's caller. unlike inspect.stack(), this doesn't
+    # build frame infos with source context for the whole stack
+    frame = sys._getframe(2)
+    fpath = frame.f_code.co_filename
+    lineno = frame.f_lineno
 
-    caller_globals = loop_frame_info[0].f_globals
-    caller_locals = loop_frame_info[0].f_locals
+    caller_globals = frame.f_globals
+    caller_locals = frame.f_locals
 
-    # create a unique name in the caller namespace that we can safely write
-    # the values of the iteration variables into
-    unique = unique_name(chain(caller_locals.keys(), caller_globals.keys()))
     loop_id = None
+    # can't equal any stamp, including the None of a missing file, so that
+    # the first iteration always loads the loop body
+    stamp = object()
 
     for i, itervar_values in enumerate(seq):
+        # only reload if the file was written since the last reload
         if i % every == 0:
-            compiled_body, itervars, loop_id = get_loop_code(loop_frame_info, loop_id=loop_id)
+            new_stamp = file_stamp(fpath)
+            if new_stamp != stamp:
+                stamp = new_stamp
+                compiled_body, loop_id = get_loop_code(fpath, lineno, loop_id=loop_id)
 
-        caller_locals[unique] = itervar_values
-        exec(itervars + " = " + unique, caller_globals, caller_locals)
-        try:
-            # run main loop body
-            exec(compiled_body, caller_globals, caller_locals)
-        except Exception:
-            handle_exception(fpath)
+        while True:
+            # stored before every try, as a nested reloading loop in the
+            # body overwrites it
+            caller_locals[_ITERVARS_NAME] = itervar_values
+            try:
+                # run main loop body
+                exec(compiled_body, caller_globals, caller_locals)
+                break
+            except Exception:
+                # let the user fix the body, then retry this iteration
+                handle_exception(fpath)
+                stamp = file_stamp(fpath)
+                compiled_body, loop_id = get_loop_code(fpath, lineno, loop_id=loop_id)
 
     return []
 
 
+# functions to get the name of a decorator, by type of the decorator's node,
+# e.g. `@reloading`, `@module.reloading` or `@reloading(every=2)`
+_DECORATOR_NAME_GETTERS = {
+    ast.Name: lambda dec_node: dec_node.id,
+    ast.Attribute: lambda dec_node: dec_node.attr,
+    ast.Call: lambda dec_node: get_decorator_name_or_none(dec_node.func),
+}
+
+
 def get_decorator_name_or_none(dec_node):
-    if hasattr(dec_node, "id"):
-        return dec_node.id
-    elif hasattr(dec_node.func, "id"):
-        return dec_node.func.id
-    elif hasattr(dec_node.func.value, "id"):
-        return dec_node.func.value.id
-    else:
+    get_name = _DECORATOR_NAME_GETTERS.get(type(dec_node))
+    if get_name is None:
         return None
+    return get_name(dec_node)
 
 
 def strip_reloading_decorator(func):
-    """Remove the 'reloading' decorator and all decorators before it"""
-    decorator_names = [get_decorator_name(dec) for dec in func.decorator_list]
+    """Returns a copy of `func` without the 'reloading' decorator and all
+    decorators before it"""
+    decorator_names = [get_decorator_name_or_none(dec) for dec in func.decorator_list]
     reloading_idx = decorator_names.index("reloading")
+    func = copy.copy(func)
     func.decorator_list = func.decorator_list[reloading_idx + 1:]
+    return func
 
 
-def isolate_function_def(funcname, tree):
-    """Strip everything but the function definition from the ast in-place.
-    Also strips the reloading decorator from the function definition"""
-    for node in ast.walk(tree):
-        if (
-            isinstance(node, ast.FunctionDef)
-            and node.name == funcname
-            and "reloading" in [
-                get_decorator_name_or_none(dec)
-                for dec in node.decorator_list
-            ]
-        ):
-            strip_reloading_decorator(node)
-            tree.body = [ node ]
-            return True
-    return False
+def isolate_function_def(funcname, index):
+    """Returns a new module containing only the function definition, stripped
+    of the reloading decorator, and the definition's line range, or None if
+    not found. Leaves the indexed tree untouched"""
+    node = index.functions_by_name.get(funcname)
+    if node is None:
+        return None
+    function_def = ast.Module(body=[strip_reloading_decorator(node)], type_ignores=[])
+    return function_def, get_line_range(node)
+
+
+# compiled function definitions, keyed by path and function name. each entry
+# holds the line range and digest of the definition the code was compiled
+# from, so that edits elsewhere in the file don't cause a re-parse
+_FUNCTION_CODE_CACHE = {}
 
 
 def get_function_def_code(fpath, fn):
-    tree = parse_file_until_successful(fpath)
-    found = isolate_function_def(fn.__name__, tree)
-    if not found:
-        return None
-    compiled = compile(tree, filename="", mode="exec")
-    return compiled
+    while True:
+        cached = _FUNCTION_CODE_CACHE.get((fpath, fn.__name__))
+        if cached is not None:
+            (start, end), digest, compiled = cached
+            if source_digest(load_source(fpath), start, end) == digest:
+                return compiled
+
+        source, _, index = parse_file_until_successful(fpath)
+        found = isolate_function_def(fn.__name__, index)
+        if found is None:
+            return None
+        function_def, (start, end) = found
+        try:
+            compiled = compile(function_def, filename=fpath, mode="exec", dont_inherit=True)
+        except SyntaxError:
+            # compile raises SyntaxErrors that parsing doesn't, e.g. for a
+            # `nonlocal` name that isn't bound in an enclosing function
+            handle_exception(fpath)
+            continue
+        # the source the tree was parsed from is the one to digest
+        digest = source_digest(source, start, end)
+        _FUNCTION_CODE_CACHE[(fpath, fn.__name__)] = ((start, end), digest, compiled)
+        return compiled
 
 
-def get_reloaded_function(caller_globals, caller_locals, fpath, fn):
-    code = get_function_def_code(fpath, fn)
-    if code is None:
-        return None
-    # need to copy locals, otherwise the exec will overwrite the decorated with the undecorated new version
-    # this became a need after removing the reloading decorator from the newly defined version
-    caller_locals_copy = caller_locals.copy()
-    exec(code, caller_globals, caller_locals_copy)
-    func = caller_locals_copy[fn.__name__]
-    return func
+def define_function(code, caller_globals, caller_locals, funcname):
+    """Executes the compiled function definition `code` and returns the new function"""
+    # define the function in an empty mapping layered over the locals, otherwise the exec will
+    # overwrite the decorated with the undecorated new version. names are still looked up in
+    # the locals, e.g. for decorators or default values, but without copying them on each reload
+    scratch = {}
+    exec(code, caller_globals, ChainMap(scratch, caller_locals))
+    return scratch[funcname]
 
 
 def _reloading_function(fn, every=1):
-    stack = inspect.stack()
-    frame, fpath = stack[2][:2]
+    frame = sys._getframe(2)
+    fpath = frame.f_code.co_filename
     caller_locals = frame.f_locals
     caller_globals = frame.f_globals
 
-    # crutch to use dict as python2 doesn't support nonlocal
-    state = {
-        "func": None,
-        "reloads": 0,
-    }
+    func = fn
+    code = None
+    # can't equal any stamp, so that the first call picks up edits made after
+    # the script started, before the function was decorated
+    stamp = object()
+    reloads = 0
+
+    def reload():
+        nonlocal func, code
+        new_code = get_function_def_code(fpath, fn)
+        # only define the function again if its definition changed, and not
+        # e.g. if the file was edited elsewhere
+        if new_code is not None and new_code is not code:
+            code = new_code
+            func = define_function(code, caller_globals, caller_locals, fn.__name__)
 
     def wrapped(*args, **kwargs):
-        if state["reloads"] % every == 0:
-            state["func"] = get_reloaded_function(caller_globals, caller_locals, fpath, fn) or state["func"]
-        state["reloads"] += 1
+        nonlocal stamp, reloads
+        if reloads % every == 0:
+            new_stamp = file_stamp(fpath)
+            if new_stamp != stamp:
+                stamp = new_stamp
+                reload()
+        reloads += 1
         while True:
             try:
-                result = state["func"](*args, **kwargs)
+                result = func(*args, **kwargs)
                 return result
             except Exception:
                 handle_exception(fpath)
-                state["func"] = get_reloaded_function(caller_globals, caller_locals, fpath, fn) or state["func"]
+                reload()
 
     caller_locals[fn.__name__] = wrapped
     return wrapped
@@ -1,9 +1,14 @@
 import unittest
+import ast
 import os
 import subprocess as sp
+import sys
 import time
+import threading
 
 from reloading import reloading
+from reloading.reloading import parse_file_until_successful, get_loop_code, get_function_def_code, load_file, iter_statements
+from reloading.reloading import _SOURCE_CACHE, _AST_CACHE, _LOOP_CODE_CACHE, _FUNCTION_CODE_CACHE
 
 SRC_FILE_NAME = "temporary_testing_file.py"
 
@@ -40,6 +45,39 @@ for epoch in reloading(range(10)):
     reload_this_fn()
 """
 
+TEST_EDIT_BEFORE_DECORATING_FN_CONTENT = """
+from reloading import reloading
+from time import sleep
+
+sleep(1)
+
+@reloading
+def reload_this_fn():
+    print('INITIAL_FILE_CONTENTS')
+
+reload_this_fn()
+"""
+
+TEST_CHANGING_SOURCE_ATTRIBUTE_DECORATED_FN_CONTENT = """
+import reloading
+from time import sleep
+
+@reloading.reloading
+def reload_this_fn():
+    print('INITIAL_FILE_CONTENTS')
+
+for epoch in range(10):
+    sleep(0.2)
+    reload_this_fn()
+"""
+
+TEST_ATTRIBUTE_LOOP_CONTENT = """
+import reloading
+
+for i in reloading.reloading(range(2)):
+    print('ATTRIBUTE_LOOP_RAN')
+"""
+
 TEST_KEEP_LOCAL_VARIABLES_CONTENT = """
 from reloading import reloading
 from time import sleep
@@ -60,6 +98,52 @@ for epoch in reloading(range(1)):
 assert state == 'CHANGED'
 """
 
+TEST_TUPLE_ITERVARS_CONTENT = """
+from reloading import reloading
+
+seen = []
+for i, (a, b) in reloading(enumerate([(1, 2), (3, 4)])):
+    seen.append((i, a, b))
+
+assert seen == [(0, 1, 2), (1, 3, 4)]
+
+for first, *rest in reloading([(1, 2, 3)]):
+    seen.append((first, rest))
+
+assert seen[-1] == (1, [2, 3])
+print('ITERVARS_ASSIGNED')
+"""
+
+TEST_RETRY_AFTER_NESTED_LOOP_CONTENT = """
+from reloading import reloading
+
+failed = False
+seen = []
+for outer in reloading(["A", "B"]):
+    for inner in reloading([1, 2, 3]):
+        pass
+    if not failed:
+        failed = True
+        raise ValueError("fails once")
+    seen.append(outer)
+
+assert seen == ["A", "B"], seen
+print('RETRIED_WITH_OUTER_VALUE')
+"""
+
+TEST_LOOP_NEXT_TO_METHOD_CALL_LOOP_CONTENT = """
+from reloading import reloading
+
+for word in "a b".split():
+    pass
+
+def train():
+    for epoch in reloading(range(1)):
+        print('LOOP_IN_FUNCTION_RAN')
+
+train()
+"""
+
 TEST_COMMENT_AFTER_LOOP_CONTENT = """
 from reloading import reloading
 from time import sleep
@@ -95,23 +179,25 @@ for _ in range(10):
 """
 
 
-def run_and_update_source(init_src, updated_src=None, update_after=0.5, bin="python3"):
+def run_and_update_source(init_src, updated_src=None, update_after=0.5, bin="python3", input=None):
     """Runs init_src in a subprocess and updates source to updated_src after
-    update_after seconds. Returns the standard output of the subprocess and
-    whether the subprocess produced an uncaught exception.
+    update_after seconds. If given, input is sent to the standard input of the
+    subprocess. Returns the standard output of the subprocess and whether the
+    subprocess produced an uncaught exception.
     """
     with open(SRC_FILE_NAME, "w") as f:
         f.write(init_src)
 
     cmd = [bin, SRC_FILE_NAME]
-    with sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE) as proc:
+    stdin = sp.PIPE if input is not None else None
+    with sp.Popen(cmd, stdin=stdin, stdout=sp.PIPE, stderr=sp.PIPE) as proc:
         if updated_src is not None:
             time.sleep(update_after)
             with open(SRC_FILE_NAME, "w") as f:
                 f.write(updated_src)
 
         try:
-            stdout, _ = proc.communicate(timeout=2)
+            stdout, _ = proc.communicate(input=input, timeout=2)
             stdout = stdout.decode("utf-8")
             has_error = False
         except:
@@ -125,12 +211,38 @@ def run_and_update_source(init_src, updated_src=None, update_after=0.5, bin="pyt
     return stdout, has_error
 
 
+def clear_caches():
+    """Forgets all sources and code read by tests running in this process, so
+    that tests reusing SRC_FILE_NAME don't see each other's entries"""
+    for cache in (_SOURCE_CACHE, _AST_CACHE, _LOOP_CODE_CACHE, _FUNCTION_CODE_CACHE):
+        cache.clear()
+
+
+def run_without_source_file(src):
+    """Runs src with `python -c`, so that there is no source file to reload
+    from, pressing return once. Returns the standard error of the subprocess
+    """
+    cmd = ["python3", "-c", src]
+    proc = sp.run(cmd, input=b"\n", stdout=sp.PIPE, stderr=sp.PIPE, timeout=5)
+    return proc.stderr.decode("utf-8")
+
+
 class TestReloading(unittest.TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def tearDown(self):
+        clear_caches()
+
     def test_simple_looping(self):
         iters = 0
         for _ in reloading(range(10)):
             iters += 1
 
+    def test_empty_looping(self):
+        for _ in reloading([]):
+            self.fail("An empty iterable should not be iterated")
+
     def test_changing_source_loop(self):
         for bin in ["python", "python3"]:
             stdout, _ = run_and_update_source(
@@ -185,6 +297,32 @@ class TestReloading(unittest.TestCase):
             _, has_error = run_and_update_source(init_src=TEST_PERSIST_AFTER_LOOP, bin=bin)
             self.assertFalse(has_error)
 
+    def test_tuple_itervars(self):
+        stdout, _ = run_and_update_source(init_src=TEST_TUPLE_ITERVARS_CONTENT)
+        self.assertTrue("ITERVARS_ASSIGNED" in stdout)
+
+    def test_loop_next_to_method_call_loop(self):
+        stdout, _ = run_and_update_source(init_src=TEST_LOOP_NEXT_TO_METHOD_CALL_LOOP_CONTENT)
+        self.assertTrue("LOOP_IN_FUNCTION_RAN" in stdout)
+
+    def test_retry_after_nested_loop(self):
+        # pressing return once retries the failed iteration
+        stdout, _ = run_and_update_source(init_src=TEST_RETRY_AFTER_NESTED_LOOP_CONTENT, input=b"\n")
+        self.assertTrue("RETRIED_WITH_OUTER_VALUE" in stdout)
+
+    def test_disabled_by_environment(self):
+        def some_func():
+            return "result"
+
+        os.environ["RELOADING"] = "0"
+        try:
+            seq = range(10)
+            self.assertIs(reloading(seq), seq)
+            self.assertIs(reloading(some_func), some_func)
+            self.assertIs(reloading(every=2)(some_func), some_func)
+        finally:
+            del os.environ["RELOADING"]
+
     def test_simple_function(self):
         @reloading
         def some_func():
@@ -211,6 +349,144 @@ class TestReloading(unittest.TestCase):
 
             self.assertTrue("INITIAL_FILE_CONTENTS" in stdout and "CHANGED_FILE_CONTENTS" in stdout)
 
+    def test_parsed_file_is_cached_until_changed(self):
+        with open(SRC_FILE_NAME, "w") as f:
+            f.write("a = 1\n")
+        try:
+            _, tree, _ = parse_file_until_successful(SRC_FILE_NAME)
+            self.assertIs(parse_file_until_successful(SRC_FILE_NAME)[1], tree)
+
+            # touching the file changes its stamp, but not its source
+            os.utime(SRC_FILE_NAME, ns=(0, 0))
+            self.assertIs(parse_file_until_successful(SRC_FILE_NAME)[1], tree)
+
+            with open(SRC_FILE_NAME, "w") as f:
+                f.write("a = 1\nb = 2\n")
+            self.assertEqual(len(parse_file_until_successful(SRC_FILE_NAME)[1].body), 2)
+        finally:
+            os.remove(SRC_FILE_NAME)
+
+    def test_statements_are_iterated_in_source_order(self):
+        tree = ast.parse("try:\n    a = 1\nexcept ValueError:\n    b = 2\nelse:\n    c = 3\nfinally:\n    d = 4\n")
+        self.assertEqual([node.lineno for node in iter_statements(tree)], [1, 2, 3, 4, 6, 8])
+
+    def test_load_file_waits_for_replaced_file(self):
+        def write_source():
+            with open(SRC_FILE_NAME, "w") as f:
+                f.write("a = 1\n")
+
+        if os.path.exists(SRC_FILE_NAME):
+            os.remove(SRC_FILE_NAME)
+        with self.assertRaises(FileNotFoundError):
+            load_file(SRC_FILE_NAME)
+        # the file is missing until an editor would have finished replacing it
+        timer = threading.Timer(0.1, write_source)
+        timer.start()
+        try:
+            self.assertEqual(load_file(SRC_FILE_NAME, missing_timeout=1), b"a = 1\n\n")
+        finally:
+            timer.join()
+            os.remove(SRC_FILE_NAME)
+
+    def test_loop_without_source_file(self):
+        stderr = run_without_source_file("from reloading import reloading\nfor i in reloading(range(2)):\n    print(i)\n")
+        self.assertTrue("FileNotFoundError" in stderr)
+
+    def test_function_without_source_file(self):
+        src = "from reloading import reloading\n@reloading\ndef fails():\n    raise ValueError()\nfails()\n"
+        stderr = run_without_source_file(src)
+        self.assertTrue("FileNotFoundError" in stderr)
+
+    # before Python 3.8, nodes have no end line, so edits below the loop change its digest
+    @unittest.skipIf(sys.version_info < (3, 8), "requires end_lineno")
+    def test_loop_code_is_kept_when_editing_outside_the_loop(self):
+        src = "for i in reloading(range(2)):\n    print(i)\n"
+        with open(SRC_FILE_NAME, "w") as f:
+            f.write(src)
+        try:
+            loop_code = get_loop_code(SRC_FILE_NAME, 1, None)
+
+            with open(SRC_FILE_NAME, "w") as f:
+                f.write(src + "print('after')\n")
+            self.assertIs(get_loop_code(SRC_FILE_NAME, 1, loop_code[1]), loop_code)
+
+            with open(SRC_FILE_NAME, "w") as f:
+                f.write(src.replace("print(i)", "print(i + 1)"))
+            self.assertIsNot(get_loop_code(SRC_FILE_NAME, 1, loop_code[1]), loop_code)
+        finally:
+            os.remove(SRC_FILE_NAME)
+
+    def test_loop_code_is_reused_when_entering_the_loop_again(self):
+        with open(SRC_FILE_NAME, "w") as f:
+            f.write("for i in reloading(range(2)):\n    print(i)\n")
+        try:
+            loop_code = get_loop_code(SRC_FILE_NAME, 1, None)
+            for _ in range(2):
+                # each entry starts without knowing the loop's id
+                self.assertIs(get_loop_code(SRC_FILE_NAME, 1, None), loop_code)
+            self.assertIs(_LOOP_CODE_CACHE[(SRC_FILE_NAME, 1)][-1], loop_code)
+        finally:
+            os.remove(SRC_FILE_NAME)
+
+    def test_loop_is_found_when_entering_the_loop_again_after_lines_were_added_above(self):
+        src = "for i in reloading(range(2)):\n    print(i)\n"
+        with open(SRC_FILE_NAME, "w") as f:
+            f.write(src)
+        try:
+            loop_code = get_loop_code(SRC_FILE_NAME, 1, None)
+
+            # the loop moves, but is entered again with the line it started on
+            with open(SRC_FILE_NAME, "w") as f:
+                f.write("# a\n# b\n" + src.replace("print(i)", "print(i + 1)"))
+            new_loop_code = get_loop_code(SRC_FILE_NAME, 1, None)
+            self.assertIsNot(new_loop_code, loop_code)
+            self.assertEqual(new_loop_code[1], loop_code[1])
+        finally:
+            os.remove(SRC_FILE_NAME)
+
+    # before Python 3.8, nodes have no end line, so edits below the function change its digest
+    @unittest.skipIf(sys.version_info < (3, 8), "requires end_lineno")
+    def test_function_code_is_kept_when_editing_outside_the_function(self):
+        def some_func():
+            pass
+
+        src = "@reloading\ndef some_func():\n    return 1\n"
+        with open(SRC_FILE_NAME, "w") as f:
+            f.write(src)
+        try:
+            code = get_function_def_code(SRC_FILE_NAME, some_func)
+
+            with open(SRC_FILE_NAME, "w") as f:
+                f.write(src + "print('after')\n")
+            self.assertIs(get_function_def_code(SRC_FILE_NAME, some_func), code)
+
+            with open(SRC_FILE_NAME, "w") as f:
+                f.write(src.replace("return 1", "return 2"))
+            self.assertIsNot(get_function_def_code(SRC_FILE_NAME, some_func), code)
+        finally:
+            os.remove(SRC_FILE_NAME)
+
+    def test_edit_before_decorating_function(self):
+        # the file is edited while the script sleeps, before the function is decorated
+        stdout, _ = run_and_update_source(
+            init_src=TEST_EDIT_BEFORE_DECORATING_FN_CONTENT,
+            updated_src=TEST_EDIT_BEFORE_DECORATING_FN_CONTENT.replace("INITIAL", "CHANGED"),
+        )
+        self.assertTrue("CHANGED_FILE_CONTENTS" in stdout)
+
+    def test_changing_source_attribute_decorated_function(self):
+        stdout, _ = run_and_update_source(
+            init_src=TEST_CHANGING_SOURCE_ATTRIBUTE_DECORATED_FN_CONTENT,
+            updated_src=TEST_CHANGING_SOURCE_ATTRIBUTE_DECORATED_FN_CONTENT.replace("INITIAL", "CHANGED").rstrip("\n"),
+        )
+
+        self.assertTrue("INITIAL_FILE_CONTENTS" in stdout and "CHANGED_FILE_CONTENTS" in stdout)
+
+
+    def test_attribute_loop(self):
+        stdout, _ = run_and_update_source(init_src=TEST_ATTRIBUTE_LOOP_CONTENT)
+        self.assertTrue("ATTRIBUTE_LOOP_RAN" in stdout)
+
 
 if __name__ == "__main__":
     unittest.main()